@@ -5,110 +5,175 @@
 - Извлекает текст из .docx через Mammoth (в Markdown-подобный плоский текст)
 - Нормализует переносы/пробелы
 - Делит на "предложения" (простая эвристика)
-- Выравнивает списки предложений с difflib.SequenceMatcher
+- Выравнивает списки предложений с difflib.SequenceMatcher (слова внутри предложений — rapidfuzz Indel, если есть)
 - Рисует HTML-отчёт: слева "старое" (с <del>), справа "новое" (с <ins>)
 """
 
-import argparse, pathlib, re, json
-from dataclasses import dataclass
+import argparse, pathlib, re, json, hashlib, io, os, importlib.metadata
 from typing import List, Dict, Tuple
+from concurrent.futures import ProcessPoolExecutor
 from difflib import SequenceMatcher
+try:
+    from rapidfuzz.distance import Indel
+except ImportError:  # rapidfuzz не установлен — остаёмся на чистом difflib
+    Indel = None
+try:
+    import orjson
+except ImportError:  # без orjson пишем JSON стандартной библиотекой
+    orjson = None
 import mammoth
 
 # ---------- Нормализация ----------
 WS = re.compile(r"\s+")
-SENT_SPLIT = re.compile(r'(?<=[\.\!\?])\s+(?=[A-ZА-Я0-9])', re.UNICODE)
+WORD = re.compile(r"\S+")
+SENT_SPLIT = re.compile(r'(?<=[.!?])\s+(?=[A-ZА-Я0-9])', re.UNICODE)
+MD_STRIP = re.compile(r"[*_`>#~-]+")
 
 def normalize(s: str) -> str:
     if not s:
         return ""
-    s = s.replace("\xa0"," ").replace("\r","")
-    s = WS.sub(" ", s).strip()
+    s = s.replace("\r","")
+    s = WS.sub(" ", s).strip()  # \s+ покрывает и \xa0 — отдельный replace не нужен
     return s
 
 def to_sentences(txt: str) -> List[str]:
     txt = normalize(txt)
     if not txt:
         return []
-    if SENT_SPLIT.search(txt):
-        return [p.strip() for p in SENT_SPLIT.split(txt) if p.strip()]
-    return [txt]
-
-@dataclass
-class Sentence:
-    text: str
-    # (страниц в DOCX нет в чистом виде; оставляем только текст)
+    # один проход: текст уже без краевых пробелов, а разделитель съедает \s+,
+    # так что куски непустые и обрезать их не нужно
+    return SENT_SPLIT.split(txt)
 
 # ---------- Извлечение текста из DOCX ----------
-def docx_to_text(path: str) -> str:
+CACHE_DIR = pathlib.Path("~/.cache/docdif").expanduser()
+
+def _docx_to_markdown(path: str, use_cache: bool = True) -> str:
+    """Markdown из Mammoth; кэшируется на диске по SHA-1 содержимого файла и версии Mammoth."""
+    data = pathlib.Path(path).read_bytes()
+    if use_cache:  # без кэша хэш не считаем
+        key = hashlib.sha1(data).hexdigest()
+        cache = CACHE_DIR / f"{key}.mammoth@{importlib.metadata.version('mammoth')}.md"
+        if cache.exists():
+            return cache.read_text(encoding="utf-8")
+    md = mammoth.convert_to_markdown(io.BytesIO(data)).value
+    if use_cache:
+        try:
+            cache.parent.mkdir(parents=True, exist_ok=True)
+            tmp = cache.with_suffix(f".{os.getpid()}.tmp")
+            tmp.write_text(md, encoding="utf-8")
+            os.replace(tmp, cache)  # атомарно: параллельный запуск не увидит полуфайл
+            # записи этого файла от прежних версий Mammoth больше не понадобятся
+            for stale in CACHE_DIR.glob(f"{key}.mammoth@*.md"):
+                if stale != cache:
+                    stale.unlink(missing_ok=True)
+        except OSError:  # кэш не обязателен
+            pass
+    return md
+
+def docx_to_text(path: str, use_cache: bool = True) -> str:
     """Берём Markdown из Mammoth и приводим к плоскому тексту."""
-    with open(path, "rb") as f:
-        md = mammoth.convert_to_markdown(f).value
+    md = _docx_to_markdown(path, use_cache)
     # уберём markdown-разметку по минимуму (**, __, #, *, >) — чтобы difflib не путался
-    md = re.sub(r"[*_`>#~-]+", " ", md)
+    md = MD_STRIP.sub(" ", md)
     return normalize(md)
 
-def extract_sentences(path: str) -> List[Sentence]:
-    txt = docx_to_text(path)
-    return [Sentence(s) for s in to_sentences(txt)]
+def extract_sentences(path: str, use_cache: bool = True) -> List[str]:
+    # страниц в DOCX нет в чистом виде, так что предложение — это просто его текст
+    return to_sentences(docx_to_text(path, use_cache))
 
 # ---------- Diff utils ----------
+# предел len(a)*len(b) для Indel: битовая матрица ~3 МБ (5000×5000 слов). Длиннее —
+# склеенная таблица/список без точек: 60k слов на Indel — ~490 МБ, на difflib — единицы МБ
+INDEL_MAX_CELLS = 25_000_000
+
+def _opcodes(a: List, b: List) -> List[Tuple[str,int,int,int,int]]:
+    """Opcodes в формате SequenceMatcher.get_opcodes(): rapidfuzz (C++), если есть, иначе difflib.
+    Indel квадратичен по памяти, поэтому на очень длинных списках — тоже difflib."""
+    if Indel is None or len(a) * len(b) > INDEL_MAX_CELLS:
+        return SequenceMatcher(a=a, b=b, autojunk=False).get_opcodes()
+    # Indel отдаёт соседние insert/delete раздельно (и в любом порядке) —
+    # склеиваем их в replace, как это делает difflib
+    ops: List[Tuple[str,int,int,int,int]] = []
+    for tag, i1, i2, j1, j2 in Indel.opcodes(a, b):
+        if tag != "equal" and ops and ops[-1][0] != "equal":
+            _, i1, _, j1, _ = ops.pop()
+            tag = "replace"
+        ops.append((tag, i1, i2, j1, j2))
+    return ops
+
+def _intern(a: List[str], b: List[str]) -> Tuple[List[int], List[int]]:
+    """Заменяет строки целочисленными id: матчеру сравнивать int дешевле длинных предложений."""
+    vocab: Dict[str,int] = {}
+    return ([vocab.setdefault(t, len(vocab)) for t in a],
+            [vocab.setdefault(t, len(vocab)) for t in b])
+
 def token_diff(a: str, b: str) -> List[Tuple[str,str]]:
     """Покомпонентный diff по словам для красивой подсветки."""
-    A, B = a.split(), b.split()
-    sm2 = SequenceMatcher(a=A, b=B, autojunk=False)
+    if a == b:
+        return [("eq", a)] if a else []
+    # чистые удаление/вставка (предложения уже нормализованы — split/join ничего не меняет)
+    if not a:
+        return [("ins", b)]
+    if not b:
+        return [("del", a)]
+    # границы слов в исходных строках: куски вырезаются срезом, без " ".join по токенам
+    sa, sb = [m.span() for m in WORD.finditer(a)], [m.span() for m in WORD.finditer(b)]
+    A, B = [a[i:j] for i, j in sa], [b[i:j] for i, j in sb]
     parts: List[Tuple[str,str]] = []
-    for tag,i1,i2,j1,j2 in sm2.get_opcodes():
+    for tag, i1, i2, j1, j2 in _opcodes(A, B):
         if tag == "equal":
-            parts.append(("eq"," ".join(A[i1:i2])))
-        elif tag == "delete":
-            parts.append(("del"," ".join(A[i1:i2])))
-        elif tag == "insert":
-            parts.append(("ins"," ".join(B[j1:j2])))
-        elif tag == "replace":
-            if i1<i2: parts.append(("del"," ".join(A[i1:i2])))
-            if j1<j2: parts.append(("ins"," ".join(B[j1:j2])))
+            parts.append(("eq", a[sa[i1][0]:sa[i2-1][1]]))
+            continue
+        if i1 < i2: parts.append(("del", a[sa[i1][0]:sa[i2-1][1]]))
+        if j1 < j2: parts.append(("ins", b[sb[j1][0]:sb[j2-1][1]]))
     return parts
 
-def align_sentence_lists(old: List[Sentence], new: List[Sentence]) -> List[Dict]:
-    sm = SequenceMatcher(a=[s.text for s in old], b=[s.text for s in new], autojunk=False)
-    diffs: List[Dict] = []
-    for tag, i1, i2, j1, j2 in sm.get_opcodes():
+def _merge_opcodes(opcodes) -> List[Tuple[str,int,int]]:
+    """Разворачивает opcodes в поштучные правки (kind, i, j), схлопывая delete,
+    за которым сразу идёт insert, в replace. Только индексы — тексты подставляет вызывающий."""
+    merged: List[Tuple[str,int,int]] = []
+    pending = -1  # удалённое предложение, которое ещё может стать replace
+    for tag, i1, i2, j1, j2 in opcodes:
         if tag == "equal":
             continue
-        if tag in ("replace","delete"):
-            for i in range(i1, i2):
-                diffs.append({"type":"delete","old_text":old[i].text})
-        if tag in ("replace","insert"):
-            for j in range(j1, j2):
-                diffs.append({"type":"insert","new_text":new[j].text})
-    # Схлопнем попарно delete+insert в replace
+        for i in range(i1, i2):
+            if pending >= 0:
+                merged.append(("delete", pending, -1))
+            pending = i
+        for j in range(j1, j2):
+            if pending >= 0:
+                merged.append(("replace", pending, j)); pending = -1
+            else:
+                merged.append(("insert", -1, j))
+    if pending >= 0:
+        merged.append(("delete", pending, -1))
+    return merged
+
+def align_sentence_lists(a: List[str], b: List[str]) -> List[Dict]:
+    if a == b:  # документы совпадают — матчер не нужен
+        return []
     merged: List[Dict] = []
-    k = 0
-    while k < len(diffs):
-        d = diffs[k]
-        if d["type"]=="delete" and k+1<len(diffs) and diffs[k+1]["type"]=="insert":
-            rep = {
-                "type":"replace",
-                "old_text": d["old_text"],
-                "new_text": diffs[k+1]["new_text"],
-                "parts": token_diff(d["old_text"], diffs[k+1]["new_text"])
-            }
-            merged.append(rep); k += 2
+    # на предложениях — difflib, а не Indel: id почти все уникальны, и SequenceMatcher
+    # тут близок к линейному, а Indel квадратичен по памяти (100k предложений — ~1.2 ГБ)
+    ia, ib = _intern(a, b)
+    for kind, i, j in _merge_opcodes(SequenceMatcher(a=ia, b=ib, autojunk=False).get_opcodes()):
+        if kind == "replace":
+            merged.append({"type":"replace","old_text":a[i],"new_text":b[j],"parts":token_diff(a[i], b[j])})
+        elif kind == "delete":
+            merged.append({"type":"delete","old_text":a[i],"parts":token_diff(a[i], "")})
         else:
-            if d["type"]=="delete":
-                merged.append({"type":"delete","old_text":d["old_text"],"parts":token_diff(d["old_text"], "")})
-            else:
-                merged.append({"type":"insert","new_text":d["new_text"],"parts":token_diff("", d["new_text"])})
-            k += 1
+            merged.append({"type":"insert","new_text":b[j],"parts":token_diff("", b[j])})
     return merged
 
 # ---------- HTML отчёт ----------
+_HTML_TRANS = str.maketrans({"&": "&amp;", "<": "&lt;", ">": "&gt;"})
+
 def _mark(parts: List[Tuple[str,str]]) -> Tuple[str,str]:
     left, right = [], []
     for op, t in parts:
         if not t:
             continue
+        t = t.translate(_HTML_TRANS)
         if op == "eq":
             left.append(t); right.append(t)
         elif op == "del":
@@ -117,22 +182,7 @@ def _mark(parts: List[Tuple[str,str]]) -> Tuple[str,str]:
             right.append(f"<ins>{t}</ins>")
     return " ".join(left), " ".join(right)
 
-def write_html(diffs: List[Dict], path: str):
-    rows = []
-    for d in diffs:
-        if d["type"]=="replace":
-            l, r = _mark(d["parts"])
-        elif d["type"]=="delete":
-            l, r = _mark(d["parts"])
-        else:
-            l, r = _mark(d["parts"])
-        rows.append(f"""
-        <tr>
-          <td><div>{l}</div></td>
-          <td><div>{r}</div></td>
-        </tr>""")
-
-    html = """<!doctype html><html lang="ru"><head><meta charset="utf-8">
+HTML_HEAD = """<!doctype html><html lang="ru"><head><meta charset="utf-8">
 <title>DOCX diff (side-by-side)</title>
 <style>
 body{font-family:system-ui,Segoe UI,Roboto,Arial}
@@ -142,25 +192,51 @@ del{background:#ffecec;text-decoration:line-through}
 ins{background:#eaffea;text-decoration:none}
 </style></head><body>
 <h2>Text diff</h2>
-<table>""" + "".join(rows) + "</table></body></html>"
-    pathlib.Path(path).write_text(html, encoding="utf-8")
+<table>"""
+HTML_TAIL = "</table></body></html>"
+
+def write_html(diffs: List[Dict], path: str):
+    # пишем строки таблицы сразу в файл, не собирая весь отчёт в памяти
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(HTML_HEAD)
+        for d in diffs:
+            l, r = _mark(d["parts"])
+            f.write(f"""
+        <tr>
+          <td><div>{l}</div></td>
+          <td><div>{r}</div></td>
+        </tr>""")
+        f.write(HTML_TAIL)
 
 # ---------- CLI ----------
+def _write_json(obj, path: pathlib.Path):
+    """Большой diff.json: orjson (Rust) пишет сразу байты, в разы быстрее json.dumps."""
+    if orjson is not None:
+        path.write_bytes(orjson.dumps(obj, option=orjson.OPT_INDENT_2))
+    else:
+        path.write_text(json.dumps(obj, ensure_ascii=False, indent=2), encoding="utf-8")
+
 def main():
     ap = argparse.ArgumentParser(description="DOCX side-by-side text diff (Mammoth + difflib)")
     ap.add_argument("old_docx"); ap.add_argument("new_docx")
     ap.add_argument("--out", default="out_docx_diff")
+    ap.add_argument("--no-cache", action="store_true",
+                    help=f"do not read or write the Mammoth cache in {CACHE_DIR}")
     args = ap.parse_args()
 
     out = pathlib.Path(args.out); out.mkdir(parents=True, exist_ok=True)
 
-    old_sents = extract_sentences(args.old_docx)
-    new_sents = extract_sentences(args.new_docx)
+    # старый и новый файлы независимы — разбираем параллельно
+    # (Mammoth — чистый Python и держит GIL, поэтому процессы, а не потоки)
+    with ProcessPoolExecutor(max_workers=2) as ex:
+        f_old = ex.submit(extract_sentences, args.old_docx, not args.no_cache)
+        f_new = ex.submit(extract_sentences, args.new_docx, not args.no_cache)
+        old_sents, new_sents = f_old.result(), f_new.result()
 
     diffs = align_sentence_lists(old_sents, new_sents)
 
     # JSON на всякий случай
-    (out/"diff.json").write_text(json.dumps(diffs, ensure_ascii=False, indent=2), encoding="utf-8")
+    _write_json(diffs, out/"diff.json")
     write_html(diffs, str(out/"diff_docx.html"))
 
     print(json.dumps({
@@ -1,132 +1,254 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 """
-Clean PDF text diff using pdfplumber + difflib only.
-- Извлекает текст через pdfplumber (pdfminer.six)
+Clean PDF text diff using PyMuPDF/pdfplumber + difflib (rapidfuzz, if installed).
+- Извлекает текст через PyMuPDF (по умолчанию; постранично или по блокам вёрстки), pdfplumber (pdfminer.six) или pypdfium2
 - Нормализует переносы и пробелы
 - Делит на предложения
-- Сравнивает списки предложений с difflib.SequenceMatcher
+- Сравнивает списки предложений с difflib.SequenceMatcher (слова внутри предложений — rapidfuzz Indel, если есть)
 - Результат: JSON + HTML с <del>/<ins>
 """
 
-import argparse, re, json, pathlib
+import argparse, re, json, pathlib, os, sys, hashlib, threading, importlib.util, importlib.metadata
 from dataclasses import dataclass
-from typing import List, Dict, Tuple
+from typing import List, Dict, Tuple, Optional
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
 from difflib import SequenceMatcher
+try:
+    from rapidfuzz.distance import Indel
+except ImportError:  # rapidfuzz не установлен — остаёмся на чистом difflib
+    Indel = None
+try:
+    import orjson
+except ImportError:  # без orjson пишем JSON стандартной библиотекой
+    orjson = None
 
 # -------- нормализация --------
 WS = re.compile(r"\s+")
-HYPHEN = re.compile(r"(\w)-\n(\w)")
-SENT_SPLIT = re.compile(r'(?<=[\.\!\?])\s+(?=[A-ZА-Я0-9])', re.UNICODE)
+WORD = re.compile(r"\S+")
+HYPHEN = re.compile(r"(?<=\w)-\n(?=\w)")  # буквы — в lookaround, чтобы заменять на "" без групп
+SENT_SPLIT = re.compile(r'(?<=[.!?])\s+(?=[A-ZА-Я0-9])', re.UNICODE)
 
 def normalize(s: str) -> str:
     if not s: return ""
     s = s.replace("\r", "")
-    s = HYPHEN.sub(r"\1\2", s)    # убираем переносы по дефису
-    s = s.replace("\n", " ")
-    s = WS.sub(" ", s).strip()
+    s = HYPHEN.sub("", s)          # убираем переносы по дефису
+    s = WS.sub(" ", s).strip()     # \s+ покрывает и \n — отдельный replace не нужен
     return s
 
 def to_sentences(txt: str) -> List[str]:
     txt = normalize(txt)
     if not txt: return []
-    if SENT_SPLIT.search(txt):
-        return [p.strip() for p in SENT_SPLIT.split(txt) if p.strip()]
-    return [txt]
+    # один проход: текст уже без краевых пробелов, а разделитель съедает \s+,
+    # так что куски непустые и обрезать их не нужно
+    return SENT_SPLIT.split(txt)
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class Sentence:
     text: str
     page: int
 
 # -------- извлечение текста --------
-def extract_pdfplumber(path: str) -> List[Sentence]:
+CACHE_DIR = pathlib.Path("~/.cache/docdif").expanduser()
+
+def _pdfplumber_pages(path: str, start: int = 0, stop: Optional[int] = None) -> List[str]:
+    """Текст страниц [start, stop); вызывается и в воркерах пула, поэтому сам открывает файл."""
     import pdfplumber
-    out: List[Sentence] = []
     with pdfplumber.open(path) as pdf:
-        for i, page in enumerate(pdf.pages):
-            txt = page.extract_text() or ""
-            for s in to_sentences(txt):
-                out.append(Sentence(s, i+1))
+        return [page.extract_text() or "" for page in pdf.pages[start:stop]]
+
+def _pymupdf_pages(path: str) -> List[str]:
+    import pymupdf
+    with pymupdf.open(path) as doc:
+        return [page.get_text("text") for page in doc]
+
+# разделитель блоков вёрстки внутри текста страницы (для бэкендов, которые их различают)
+BLOCK_SEP = "\x1e"
+
+def _pymupdf_blocks_pages(path: str) -> List[str]:
+    """Текстовые блоки PyMuPDF: граница блока — всегда граница предложения."""
+    import pymupdf
+    with pymupdf.open(path) as doc:
+        # block = (x0, y0, x1, y1, text, block_no, block_type); type 1 — картинка
+        return [BLOCK_SEP.join(b[4] for b in page.get_text("blocks") if b[6] == 0) for page in doc]
+
+def _pypdfium2_pages(path: str) -> List[str]:
+    import pypdfium2 as pdfium
+    pages: List[str] = []
+    pdf = pdfium.PdfDocument(path)
+    try:
+        for i in range(len(pdf)):
+            page = pdf[i]
+            textpage = page.get_textpage()
+            try:
+                pages.append(textpage.get_text_range())
+            finally:  # textpage держит page, а page — документ: закрываем по порядку
+                textpage.close()
+                page.close()
+    finally:
+        pdf.close()
+    return pages
+
+# бэкенд -> (модуль, который он импортирует; функция "путь -> тексты страниц")
+BACKENDS = {
+    "pymupdf": ("pymupdf", _pymupdf_pages),
+    "pymupdf-blocks": ("pymupdf", _pymupdf_blocks_pages),
+    "pdfplumber": ("pdfplumber", _pdfplumber_pages),
+    "pypdfium2": ("pypdfium2", _pypdfium2_pages),
+}
+
+def extract_pages(path: str, backend: str = "pdfplumber", ex: Optional[Executor] = None,
+                  chunks: int = 1, use_cache: bool = True) -> List[str]:
+    """Сырые тексты страниц. Кэшируются на диске по SHA-1 содержимого файла, бэкенду и версии
+    его библиотеки (обновление меняет извлечённый текст) — нормализация и разбивка на предложения при этом каждый раз выполняются заново.
+    С пулом ex pdfplumber режет страницы на chunks непрерывных диапазонов,
+    остальные (C-) бэкенды быстры и разбирают файл целиком в одном воркере."""
+    if use_cache:  # без кэша файл лишний раз не читаем и не хэшируем
+        key = hashlib.sha1(pathlib.Path(path).read_bytes()).hexdigest()
+        version = importlib.metadata.version(BACKENDS[backend][0])
+        cache = CACHE_DIR / f"{key}.{backend}@{version}.json"
+        if cache.exists():
+            return json.loads(cache.read_text(encoding="utf-8"))
+    pages_fn = BACKENDS[backend][1]
+    if ex is None:
+        pages = pages_fn(path)
+    elif backend == "pdfplumber":
+        import pdfplumber
+        with pdfplumber.open(path) as pdf:
+            n = len(pdf.pages)
+        step = max(1, -(-n // chunks))
+        futs = [ex.submit(_pdfplumber_pages, path, i, i+step) for i in range(0, n, step)]
+        pages = [txt for f in futs for txt in f.result()]
+    else:
+        pages = ex.submit(pages_fn, path).result()
+    if use_cache:
+        try:
+            cache.parent.mkdir(parents=True, exist_ok=True)
+            tmp = cache.with_suffix(f".{os.getpid()}-{threading.get_ident()}.tmp")
+            tmp.write_text(json.dumps(pages, ensure_ascii=False), encoding="utf-8")
+            os.replace(tmp, cache)  # атомарно: параллельный запуск не увидит полуфайл
+            # записи этого файла от прежних версий библиотеки больше не понадобятся
+            for stale in CACHE_DIR.glob(f"{key}.{backend}@*.json"):
+                if stale != cache:
+                    stale.unlink(missing_ok=True)
+        except OSError:  # кэш не обязателен
+            pass
+    return pages
+
+def extract_sentences(path: str, backend: str = "pdfplumber", ex: Optional[Executor] = None,
+                      chunks: int = 1, use_cache: bool = True) -> List[Sentence]:
+    out: List[Sentence] = []
+    for i, txt in enumerate(extract_pages(path, backend, ex, chunks, use_cache)):
+        if not txt:  # пустые (напр. чисто графические) страницы пропускаем сразу
+            continue
+        for block in txt.split(BLOCK_SEP):
+            out.extend(Sentence(s, i+1) for s in to_sentences(block))
     return out
 
 # -------- дифф --------
+# предел len(a)*len(b) для Indel: битовая матрица ~3 МБ (5000×5000 слов). Длиннее —
+# склеенная таблица/список без точек: 60k слов на Indel — ~490 МБ, на difflib — единицы МБ
+INDEL_MAX_CELLS = 25_000_000
+
+def _opcodes(a: List, b: List) -> List[Tuple[str,int,int,int,int]]:
+    """Opcodes в формате SequenceMatcher.get_opcodes(): rapidfuzz (C++), если есть, иначе difflib.
+    Indel квадратичен по памяти, поэтому на очень длинных списках — тоже difflib."""
+    if Indel is None or len(a) * len(b) > INDEL_MAX_CELLS:
+        return SequenceMatcher(a=a, b=b, autojunk=False).get_opcodes()
+    # Indel отдаёт соседние insert/delete раздельно (и в любом порядке) —
+    # склеиваем их в replace, как это делает difflib
+    ops: List[Tuple[str,int,int,int,int]] = []
+    for tag, i1, i2, j1, j2 in Indel.opcodes(a, b):
+        if tag != "equal" and ops and ops[-1][0] != "equal":
+            _, i1, _, j1, _ = ops.pop()
+            tag = "replace"
+        ops.append((tag, i1, i2, j1, j2))
+    return ops
+
+def _intern(a: List[str], b: List[str]) -> Tuple[List[int], List[int]]:
+    """Заменяет строки целочисленными id: матчеру сравнивать int дешевле длинных предложений."""
+    vocab: Dict[str,int] = {}
+    return ([vocab.setdefault(t, len(vocab)) for t in a],
+            [vocab.setdefault(t, len(vocab)) for t in b])
+
 def token_diff(a: str, b: str) -> List[Tuple[str,str]]:
-    A, B = a.split(), b.split()
-    sm = SequenceMatcher(a=A, b=B, autojunk=False)
+    if a == b:
+        return [("eq", a)] if a else []
+    # чистые удаление/вставка (предложения уже нормализованы — split/join ничего не меняет)
+    if not a:
+        return [("ins", b)]
+    if not b:
+        return [("del", a)]
+    # границы слов в исходных строках: куски вырезаются срезом, без " ".join по токенам
+    sa, sb = [m.span() for m in WORD.finditer(a)], [m.span() for m in WORD.finditer(b)]
+    A, B = [a[i:j] for i, j in sa], [b[i:j] for i, j in sb]
     out: List[Tuple[str,str]] = []
-    for tag, i1, i2, j1, j2 in sm.get_opcodes():
+    for tag, i1, i2, j1, j2 in _opcodes(A, B):
         if tag == "equal":
-            out.append(("eq"," ".join(A[i1:i2])))
-        elif tag == "delete":
-            out.append(("del"," ".join(A[i1:i2])))
-        elif tag == "insert":
-            out.append(("ins"," ".join(B[j1:j2])))
-        elif tag == "replace":
-            if i1<i2: out.append(("del"," ".join(A[i1:i2])))
-            if j1<j2: out.append(("ins"," ".join(B[j1:j2])))
+            out.append(("eq", a[sa[i1][0]:sa[i2-1][1]]))
+            continue
+        if i1 < i2: out.append(("del", a[sa[i1][0]:sa[i2-1][1]]))
+        if j1 < j2: out.append(("ins", b[sb[j1][0]:sb[j2-1][1]]))
     return out
 
-def align_sentence_lists(old: List[Sentence], new: List[Sentence]) -> List[Dict]:
-    sm = SequenceMatcher(a=[s.text for s in old], b=[s.text for s in new], autojunk=False)
-    diffs: List[Dict] = []
-    for tag, i1, i2, j1, j2 in sm.get_opcodes():
+def _merge_opcodes(opcodes) -> List[Tuple[str,int,int]]:
+    """Разворачивает opcodes в поштучные правки (kind, i, j), схлопывая delete,
+    за которым сразу идёт insert, в replace. Только индексы — тексты подставляет вызывающий."""
+    merged: List[Tuple[str,int,int]] = []
+    pending = -1  # удалённое предложение, которое ещё может стать replace
+    for tag, i1, i2, j1, j2 in opcodes:
         if tag == "equal": continue
-        if tag in ("replace","delete"):
-            for i in range(i1, i2):
-                diffs.append({"type":"delete", "old_text":old[i].text, "old_page":old[i].page})
-        if tag in ("replace","insert"):
-            for j in range(j1, j2):
-                diffs.append({"type":"insert", "new_text":new[j].text, "new_page":new[j].page})
-    # схлопываем delete+insert в replace
+        for i in range(i1, i2):
+            if pending >= 0:
+                merged.append(("delete", pending, -1))
+            pending = i
+        for j in range(j1, j2):
+            if pending >= 0:
+                merged.append(("replace", pending, j)); pending = -1
+            else:
+                merged.append(("insert", -1, j))
+    if pending >= 0:
+        merged.append(("delete", pending, -1))
+    return merged
+
+def align_sentence_lists(old: List[Sentence], new: List[Sentence]) -> List[Dict]:
+    a, b = [s.text for s in old], [s.text for s in new]
+    if a == b:  # тексты совпадают — матчер не нужен
+        return []
+    # финальные dict-ы собираем один раз, когда форма правки уже известна
     merged: List[Dict] = []
-    k = 0
-    while k < len(diffs):
-        d = diffs[k]
-        if d["type"]=="delete" and k+1<len(diffs) and diffs[k+1]["type"]=="insert":
-            rep = {
-                "type":"replace",
-                "old_text": d["old_text"], "old_page": d["old_page"],
-                "new_text": diffs[k+1]["new_text"], "new_page": diffs[k+1]["new_page"],
-                "parts": token_diff(d["old_text"], diffs[k+1]["new_text"])
-            }
-            merged.append(rep); k+=2
+    # на предложениях — difflib, а не Indel: id почти все уникальны, и SequenceMatcher
+    # тут близок к линейному, а Indel квадратичен по памяти (100k предложений — ~1.2 ГБ)
+    ia, ib = _intern(a, b)
+    for kind, i, j in _merge_opcodes(SequenceMatcher(a=ia, b=ib, autojunk=False).get_opcodes()):
+        if kind == "replace":
+            merged.append({"type":"replace",
+                           "old_text": a[i], "old_page": old[i].page,
+                           "new_text": b[j], "new_page": new[j].page,
+                           "parts": token_diff(a[i], b[j])})
+        elif kind == "delete":
+            merged.append({"type":"delete","old_text":a[i],"old_page":old[i].page,
+                           "parts": token_diff(a[i], "")})
         else:
-            if d["type"]=="delete":
-                merged.append({"type":"delete","old_text":d["old_text"],"old_page":d["old_page"],
-                               "parts": token_diff(d["old_text"], "")})
-            else:
-                merged.append({"type":"insert","new_text":d["new_text"],"new_page":d["new_page"],
-                               "parts": token_diff("", d["new_text"])})
-            k+=1
+            merged.append({"type":"insert","new_text":b[j],"new_page":new[j].page,
+                           "parts": token_diff("", b[j])})
     return merged
 
 # -------- HTML отчёт --------
+_HTML_TRANS = str.maketrans({"&": "&amp;", "<": "&lt;", ">": "&gt;"})
+
 def _mark(parts: List[Tuple[str,str]]):
     l=[]; r=[]
     for op,t in parts:
         if not t: continue
+        t = t.translate(_HTML_TRANS)
         if op=="eq": l.append(t); r.append(t)
         elif op=="del": l.append(f"<del>{t}</del>")
         elif op=="ins": r.append(f"<ins>{t}</ins>")
     return " ".join(l), " ".join(r)
 
-def write_html(diffs: List[Dict], path: str):
-    rows=[]
-    for d in diffs:
-        if d["type"]=="replace":
-            left,right=_mark(d["parts"]); lp=d["old_page"]; rp=d["new_page"]
-        elif d["type"]=="delete":
-            left,right=_mark(d["parts"]); lp=d["old_page"]; rp=""
-        else:
-            left,right=_mark(d["parts"]); lp=""; rp=d["new_page"]
-        rows.append(f"""
-        <tr>
-          <td><small>p.{lp}</small><div>{left}</div></td>
-          <td><small>p.{rp}</small><div>{right}</div></td>
-        </tr>""")
-    html = """<!doctype html><html lang="en"><head><meta charset="utf-8">
-<title>PDF diff (pdfplumber + difflib)</title>
+HTML_HEAD = """<!doctype html><html lang="en"><head><meta charset="utf-8">
+<title>PDF diff (side-by-side)</title>
 <style>
 body{font-family:system-ui,Segoe UI,Roboto,Arial}
 table{width:100%;border-collapse:collapse}
@@ -136,20 +258,70 @@ ins{background:#eaffea;text-decoration:none}
 small{color:#666}
 </style></head><body>
 <h2>Text diff</h2>
-<table>""" + "".join(rows) + "</table></body></html>"
-    pathlib.Path(path).write_text(html, encoding="utf-8")
+<table>"""
+HTML_TAIL = "</table></body></html>"
+
+def write_html(diffs: List[Dict], path: str):
+    # строки таблицы пишем сразу в файл, не собирая весь отчёт в памяти
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(HTML_HEAD)
+        for d in diffs:
+            if d["type"]=="replace":
+                left,right=_mark(d["parts"]); lp=d["old_page"]; rp=d["new_page"]
+            elif d["type"]=="delete":
+                left,right=_mark(d["parts"]); lp=d["old_page"]; rp=""
+            else:
+                left,right=_mark(d["parts"]); lp=""; rp=d["new_page"]
+            f.write(f"""
+        <tr>
+          <td><small>p.{lp}</small><div>{left}</div></td>
+          <td><small>p.{rp}</small><div>{right}</div></td>
+        </tr>""")
+        f.write(HTML_TAIL)
 
 # -------- CLI --------
+def _write_json(obj, path: pathlib.Path):
+    """Большой diff.json: orjson (Rust) пишет сразу байты, в разы быстрее json.dumps."""
+    if orjson is not None:
+        path.write_bytes(orjson.dumps(obj, option=orjson.OPT_INDENT_2))
+    else:
+        path.write_text(json.dumps(obj, ensure_ascii=False, indent=2), encoding="utf-8")
+
+def _positive_int(s: str) -> int:
+    """type= для argparse: целое >= 1 (0 ломает пул процессов и деление на чанки)."""
+    try:
+        n = int(s)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected an integer, got {s!r}")
+    if n < 1:
+        raise argparse.ArgumentTypeError(f"must be >= 1, got {n}")
+    return n
+
 def main():
-    ap = argparse.ArgumentParser(description="Clean PDF text diff (pdfplumber + difflib)")
+    ap = argparse.ArgumentParser(description="Clean PDF text diff (PyMuPDF/pdfplumber + difflib)")
     ap.add_argument("old_pdf"); ap.add_argument("new_pdf")
     ap.add_argument("--out", default="out")
+    ap.add_argument("--backend", choices=list(BACKENDS), default="pymupdf",
+                    help="text extraction library; falls back to pdfplumber if not installed")
+    ap.add_argument("--workers", type=_positive_int, default=min(os.cpu_count() or 1, 4),
+                    help="processes for page text extraction (default: min(CPU count, 4))")
+    ap.add_argument("--no-cache", action="store_true",
+                    help=f"do not read or write the extracted page text cache in {CACHE_DIR}")
     args = ap.parse_args()
 
+    backend = args.backend
+    if importlib.util.find_spec(BACKENDS[backend][0]) is None:
+        print(f"{backend} is not installed, falling back to pdfplumber", file=sys.stderr)
+        backend = "pdfplumber"
+
     outdir = pathlib.Path(args.out); outdir.mkdir(parents=True, exist_ok=True)
 
-    old = extract_pdfplumber(args.old_pdf)
-    new = extract_pdfplumber(args.new_pdf)
+    # извлечение идёт в одном пуле процессов (pdfminer — чистый Python и держит GIL);
+    # два потока лишь раздают задачи, чтобы старый и новый файл разбирались вперемешку
+    with ProcessPoolExecutor(max_workers=args.workers) as ex, ThreadPoolExecutor(max_workers=2) as tx:
+        f_old = tx.submit(extract_sentences, args.old_pdf, backend, ex, args.workers, not args.no_cache)
+        f_new = tx.submit(extract_sentences, args.new_pdf, backend, ex, args.workers, not args.no_cache)
+        old, new = f_old.result(), f_new.result()
 
     diffs = align_sentence_lists(old, new)
 
@@ -163,12 +335,10 @@ def main():
     meta = {
         "old_file": pathlib.Path(args.old_pdf).name,
         "new_file": pathlib.Path(args.new_pdf).name,
+        "backend": backend,
     }
 
-    (outdir/"diff.json").write_text(
-        json.dumps({"meta": meta, "diffs": diffs}, ensure_ascii=False, indent=2),
-        encoding="utf-8"
-    )
+    _write_json({"meta": meta, "diffs": diffs}, outdir/"diff.json")
     write_html(diffs, str(outdir/"diff.html"))
 
     print(json.dumps({